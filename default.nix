@@ -3,7 +3,7 @@
 let
   pkgs = import <nixpkgs> {};
 
-  inherit (pkgs.python3.pkgs) buildPythonApplication requests setuptools;
+  inherit (pkgs.python3.pkgs) buildPythonApplication requests setuptools zstandard;
 
 in buildPythonApplication {
   pname = "nartool";
@@ -14,6 +14,6 @@ in buildPythonApplication {
   src = ./.;
 
   nativeBuildInputs =  [ setuptools ];
-  propagatedBuildInputs = [ requests ];
+  propagatedBuildInputs = [ requests zstandard ];
 }
 
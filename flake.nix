@@ -9,7 +9,8 @@
       inherit (pkgs.python3.pkgs)
         buildPythonApplication
         setuptools
-        requests;
+        requests
+        zstandard;
     in
       buildPythonApplication {
         pname = "nartool";
@@ -20,7 +21,7 @@
         src = ./.;
 
         nativeBuildInputs =  [ setuptools ];
-        propagatedBuildInputs = [ requests ];
+        propagatedBuildInputs = [ requests zstandard ];
       };
   };
 }
@@ -173,7 +173,7 @@ def main():
             size_old, size_new = ns.recompress_nar(list(hashes), args.compression[0])
 
             diff = size_old - size_new
-            perc = float(diff)/float(size_old) * 100.0
+            perc = float(diff)/float(size_old) * 100.0 if size_old > 0 else 0.0
             print("Old size {}, new size {}, saved {} ({:.2f} %)".format(size_old, size_new, diff, perc))
 
     elif args.command == "nixcopy":
@@ -2,31 +2,68 @@
 
 import os
 import sys
-import re
 import json
 import pathlib
 import typing
+import pickle
+import atexit
+import lzma
+import io
+import hashlib
+import base64
+import threading
+import functools
+import copy
+import shutil
 
 import subprocess
 
 from typing import List
 from dataclasses import dataclass
-from dataclasses import asdict
+from dataclasses import fields
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 import requests
+import zstandard
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of concurrent requests to binary caches
+HTTP_WORKERS = 32
+
+# Number of threads reading narinfo files. On local storage parsing
+# dominates and holds the GIL, so threads only add overhead. Raise it for
+# stores on network file systems, where each read waits for the server.
+READ_WORKERS = 1
+
+# Block size for streaming NAR files
+CHUNK_SIZE = 1 << 20
+
+# Characters of Nix' base32 alphabet
+NIX32_CHARS = "0123456789abcdfghijklmnpqrsvwxyz"
+_NIX32_CHARSET = frozenset(NIX32_CHARS)
 
 def nix_hash_is_valid(hash: str) -> bool:
-    if not re.match(r"[0-9abcdfghijklmnpqrsvwxyz]{32}", hash):
-        return False
+    return len(hash) == 32 and _NIX32_CHARSET.issuperset(hash)
+
+def nixbase32_encode(digest: bytes) -> str:
+    '''Encode a hash digest in Nix' base32 representation (as nix hash --base32)
+    '''
+    # Nix reads the digest as little endian number and prints
+    # it in groups of 5 bits, starting with the most significant
+    length = (len(digest) * 8 - 1) // 5 + 1
+    number = int.from_bytes(digest, 'little')
 
-    return True
+    return "".join(NIX32_CHARS[(number >> (5 * i)) & 0x1f] for i in reversed(range(length)))
 
 def check_nix_hash(hash: str) -> str:
     if not nix_hash_is_valid(hash):
-        raise Exception("Hash is not valid Nix store path hash: " +  hash)
+        raise Exception(f"Hash is not valid Nix store path hash: {hash}")
 
     return hash
 
+@functools.lru_cache(maxsize=1 << 16)
 def hash_from_name(name: str) -> str:
     '''Convert a file name into NIX store hash
     '''
@@ -42,6 +79,142 @@ def hash_from_name(name: str) -> str:
 
     return hash
 
+def sri_to_base32(hash: str) -> str:
+    '''Convert a sha256 hash from SRI (sha256-<base64>) or
+       Nix (sha256:<base16|base32>) notation to Nix base32
+    '''
+    if hash.startswith("sha256-"):
+        return nixbase32_encode(base64.b64decode(hash[7:]))
+
+    if hash.startswith("sha256:"):
+        hash = hash[7:]
+
+    # base16
+    if len(hash) == 64:
+        return nixbase32_encode(bytes.fromhex(hash))
+
+    return hash
+
+def http_session(pool_size: int = HTTP_WORKERS) -> requests.Session:
+    '''Create a HTTP session, which keeps up to 2 * pool_size connections alive
+       and retries transient server errors
+    '''
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("HEAD", "GET"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=2 * pool_size, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+# zstd contexts are not thread safe, keep one set per thread
+_zstd_contexts = threading.local()
+
+def _zstd_compressor() -> zstandard.ZstdCompressor:
+    '''Get the zstd compression context of the current thread
+    '''
+    if not hasattr(_zstd_contexts, "compressor"):
+        _zstd_contexts.compressor = zstandard.ZstdCompressor()
+
+    return _zstd_contexts.compressor
+
+def _zstd_decompressor() -> zstandard.ZstdDecompressor:
+    '''Get the zstd decompression context of the current thread
+    '''
+    if not hasattr(_zstd_contexts, "decompressor"):
+        _zstd_contexts.decompressor = zstandard.ZstdDecompressor()
+
+    return _zstd_contexts.decompressor
+
+def _fadvise(file: typing.BinaryIO, advice: str):
+    '''Tell the kernel how file will be accessed (e.g. "POSIX_FADV_SEQUENTIAL").
+       A no-op on platforms without posix_fadvise
+    '''
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(file.fileno(), 0, 0, getattr(os, advice))
+
+def _open_decompressor(file: typing.BinaryIO, compression: str) -> typing.BinaryIO:
+    '''Wrap a compressed binary file for reading the uncompressed NAR.
+       For "none" file itself is returned, closing it closes file.
+       Otherwise closing the returned object does not close file.
+    '''
+    if compression == "none":
+        return file
+    elif compression == "xz":
+        return lzma.open(file, 'rb')
+    elif compression == "zstd":
+        return _zstd_decompressor().stream_reader(file, read_across_frames=True, closefd=False)
+    else:
+        raise Exception(f'Unsupported compression type: {compression}')
+
+def _open_compressor(file: typing.BinaryIO, compression: str) -> typing.BinaryIO:
+    '''Wrap a binary file, compressing everything written to it.
+       For "none" file itself is returned, closing it closes file.
+       Otherwise closing the returned object does not close file.
+    '''
+    if compression == "none":
+        return file
+    elif compression == "xz":
+        return lzma.open(file, 'wb')
+    elif compression == "zstd":
+        return _zstd_compressor().stream_writer(file, closefd=False)
+    else:
+        raise Exception(f'Unsupported compression type: {compression}')
+
+class _HashWriter(io.RawIOBase):
+    '''Pass writes on to file and compute their sha256
+    '''
+    def __init__(self, file: typing.BinaryIO):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        return self.file.write(data)
+
+def _remove_if_exists(path: str):
+    '''Remove a (temporary) file, which may not have been created yet
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        None
+
+# Keys of narinfo files, which are not stored as plain strings
+_NARINFO_SETTERS = {
+    "Sig": lambda info, value: info.Sig.append(value),
+    "References": lambda info, value: setattr(info, "References", value.split()),
+    "NarSize": lambda info, value: setattr(info, "NarSize", int(value)),
+    "FileSize": lambda info, value: setattr(info, "FileSize", int(value)),
+}
+
+def available_caches(cache_urls: List[str], session: requests.Session) -> List[str]:
+    '''Filter out caches, which do not serve a nix-cache-info file.
+       Local caches (absolute paths) are passed through.
+    '''
+    available = []
+    for cache in cache_urls:
+        # e.g. a trailing comma in the list of caches
+        if cache == "":
+            continue
+
+        if not cache.startswith("/"):
+            try:
+                res = session.get(f"{cache}/nix-cache-info", timeout=10)
+                if res.status_code != 200:
+                    print(f"Warning: {cache} is not a binary cache, skipping it", file=sys.stderr)
+                    continue
+            except requests.RequestException:
+                print(f"Warning: {cache} is not reachable, skipping it", file=sys.stderr)
+                continue
+
+        available.append(cache)
+
+    return available
+
 @dataclass
 class NarInfo:
     StorePath: str
@@ -57,55 +230,79 @@ class NarInfo:
     System: typing.Optional[str] = None
     CA: typing.Optional[str] = None
 
-    def __init__(self, text: typing.Optional[str] = None):
+    def __init__(self, text: typing.Optional[typing.Union[str, typing.Iterable[str]]] = None):
+        '''Parse narinfo from a string or an iterable of lines (e.g. a file object)
+        '''
         self.Sig = []
         self.References = []
         self.Deriver = None
 
         if text != None:
-            for line in text.split("\n"):
-                kv = line.split(': ')
-                if len(kv) == 2:
-                    key = kv[0]
-                    value = kv[1].strip()
-
-                    if key == "FileSize" or key == "NarSize":
-                        value = int(value)
-
-                    if key == "Sig":
-                        self.Sig.append(value)
-                    elif key == "References":
-                        self.References = value.split(" ")
-                        if len(self.References) > 0 and len(self.References[-1]) == 0:
-                            self.References.pop()
+            if isinstance(text, str):
+                text = text.splitlines()
+
+            for line in text:
+                key, sep, value = line.partition(': ')
+                if sep:
+                    value = value.strip()
+                    setter = _NARINFO_SETTERS.get(key)
+                    if setter != None:
+                        setter(self, value)
                     else:
                         setattr(self, key, value)
 
+    @property
+    def ref_hashes(self) -> List[str]:
+        '''Store path hashes of the references
+        '''
+        # References are store path basenames, which start with the hash
+        return [ref[:32] for ref in self.References]
+
     def to_str(self) -> str:
+        lines = []
+        for field in _NARINFO_FIELDS:
+            value = getattr(self, field, None)
+            if value == None or value == []:
+                continue
+
+            if field == "Sig":
+                # One line per signature
+                lines.extend(f"Sig: {sig}\n" for sig in value)
+            elif isinstance(value, list):
+                lines.append(f"{field}: {' '.join(value)}\n")
+            else:
+                lines.append(f"{field}: {value}\n")
 
-        text = ""
-        for field in [a for a in dir(self) if not (a.startswith('__') or a.startswith('to_'))]:
-            value = getattr(self, field)
-            if type(value) == list:
-                if not value:
-                    value = None
-                else:
-                    value = " ".join(value)
-            if value != None:
-                text = text + field + ": " + str(value) + "\n"
+        return "".join(lines)
+
+    def copy(self) -> 'NarInfo':
+        '''Copy of the narinfo, which shares no lists with the original
+        '''
+        info = copy.copy(self)
+        info.Sig = list(self.Sig)
+        info.References = list(self.References)
 
+        return info
 
-        return text
+    def to_dict(self) -> dict:
+        '''Shallow dict of the narinfo fields. Unlike asdict no deep copy is made
+        '''
+        return {field: getattr(self, field, None) for field in _NARINFO_FIELDS}
 
     def to_json(self) -> str:
-        return json.dumps(asdict(self))
+        return json.dumps(self.to_dict())
 
 
     def __repr__(self):
         return self.to_json()
 
+# Names of all narinfo fields
+_NARINFO_FIELDS = tuple(f.name for f in fields(NarInfo))
+
 class Closure(dict):
-    '''Represent a closure of narinfo files
+    '''Represent a closure of narinfo files.
+       Keys are store path hashes, while the References of each
+       narinfo are store path basenames (<hash>-<name>)
     '''
 
     @staticmethod
@@ -116,7 +313,7 @@ class Closure(dict):
 
     @staticmethod
     def value_is_valid(value):
-        if type(value) != NarInfo:
+        if not isinstance(value, NarInfo):
             raise Exception("Value is not of type NarInfo")
 
         return value
@@ -140,6 +337,15 @@ class Closure(dict):
 
         super().__setitem__(key, value)
 
+    @classmethod
+    def unchecked(cls, mapping=None):
+        '''Create a closure from trusted data (e.g. our own store) without validation
+        '''
+        closure = cls.__new__(cls)
+        dict.__init__(closure, mapping or {})
+
+        return closure
+
 class NixStore:
     def __init__(self):
         self.store_dir = "/nix/store"
@@ -148,29 +354,69 @@ class NixStore:
         ''' Returns an incomplete NarInfo
         '''
 
-        if path[0] != "/":
-            path = os.path.join(self.store_dir, path)
-
-        path_info = subprocess.run(['nix', 'path-info', '--json', path], stdout=subprocess.PIPE).stdout.decode().strip()
-        path_info = json.loads(path_info)[0]
+        infos = self.narinfo_many([ path ])
+        if not infos:
+            raise Exception(f"Not a valid store path: {path}")
 
-        # construct
-        info = NarInfo()
-        info.URL = ""
-        info.StorePath = path_info['path']
-        info.NarHash = subprocess.run(['nix', 'hash', 'to-base32', path_info['narHash']], stdout=subprocess.PIPE).stdout.decode().strip()
-        info.NarHash = "sha256:" + info.NarHash  #FIXME
-        info.NarSize = path_info['narSize']
-        for ref in path_info['references']:
-            info.References.append(os.path.basename(ref))
+        return next(iter(infos.values()))
 
-        if "deriver" in path_info:
-            info.Deriver = path_info['deriver']
+    def narinfo_many(self, paths: List[str]) -> typing.Dict[str, NarInfo]:
+        ''' Returns incomplete NarInfos for many paths with a single nix call.
+            Invalid paths are skipped.
+        '''
 
-        return info
+        paths = [ path if path.startswith("/") else os.path.join(self.store_dir, path) for path in paths ]
+
+        try:
+            res = subprocess.run(['nix', 'path-info', '--json', *paths], stdout=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError:
+            # A single invalid path fails the whole query, query them one by one
+            infos = {}
+            if len(paths) > 1:
+                for path in paths:
+                    infos.update(self.narinfo_many([ path ]))
+            return infos
+
+        try:
+            path_infos = json.loads(res.stdout)
+        except json.JSONDecodeError as e:
+            raise Exception(f"Can not parse output of nix path-info: {e}")
+        # Newer versions of Nix return an object keyed by path
+        if isinstance(path_infos, dict):
+            path_infos = [ dict(path_info, path=path) for path, path_info in path_infos.items() if path_info != None ]
+
+        infos = {}
+        for path_info in path_infos:
+            # construct
+            info = NarInfo()
+            info.URL = ""
+            info.StorePath = path_info['path']
+            info.NarHash = f"sha256:{sri_to_base32(path_info['narHash'])}"
+            info.NarSize = path_info['narSize']
+            for ref in path_info['references']:
+                info.References.append(os.path.basename(ref))
+
+            if path_info.get('deriver') != None:
+                info.Deriver = path_info['deriver']
+
+            infos[hash_from_name(info.StorePath)] = info
+
+        return infos
+
+    def dump_nar_to(self, info: NarInfo, file: typing.BinaryIO):
+        '''Write the NAR of a store path to file. nix writes to plain files directly,
+           other writers (e.g. compressors) are fed through a pipe
+        '''
+        cmd = ['nix', 'nar', 'dump-path', info.StorePath]
+        if isinstance(file, (io.FileIO, io.BufferedWriter)):
+            subprocess.run(cmd, stdout=file, check=True)
+            return
 
-    def dump_nar(self, info: NarInfo) -> bytes:
-        return subprocess.run(['nix', 'nar', 'dump-path', info.StorePath], stdout=subprocess.PIPE).stdout
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            while chunk := proc.stdout.read(CHUNK_SIZE):
+                file.write(chunk)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
 
     def get_closure(self, path: str, closure: typing.Optional[Closure] = None) -> Closure:
         '''Get a closure from a nix store path
@@ -178,37 +424,233 @@ class NixStore:
         if closure == None:
             closure = Closure()
 
-        hash = hash_from_name(path)
-        if hash not in closure:
-            try:
-                closure[hash] = self.narinfo(path)
+        # Query the closure level by level, one nix call per level
+        frontier = [ path ]
+        visited = set(closure) | { hash_from_name(path) }
 
-                for ref in closure[hash].References:
-                   if hash_from_name(ref) != hash:
-                        closure = self.get_closure(ref, closure)
-            except:
-                None
+        while frontier:
+            infos = self.narinfo_many(frontier)
+
+            frontier = []
+            for hash, info in infos.items():
+                closure[hash] = info
+                for ref in info.References:
+                    if ref[:32] not in visited:
+                        visited.add(ref[:32])
+                        frontier.append(ref)
 
         return closure
 
 
 
+def _copy_nar_file(nix_store: NixStore, store_dir: str, info: NarInfo, compression: str, ext: str) -> NarInfo:
+    '''Dump and compress the NAR of a single store path. Returns the updated narinfo
+    '''
+    print(f"copy: {info.StorePath}", file=sys.stderr)
+    info.URL = os.path.join("nar", f"{info.NarHash[7:]}.nar") #FIXME
+
+    nar_path = os.path.join(store_dir, info.URL + ext)
+    tmp_name = f'{nar_path}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp_name, 'wb') as file:
+            if compression == "none":
+                nix_store.dump_nar_to(info, file)
+            else:
+                out = _HashWriter(file)
+                with _open_compressor(out, compression) as dst:
+                    nix_store.dump_nar_to(info, dst)
+    except BaseException:
+        # Do not leave a partial NAR behind
+        _remove_if_exists(tmp_name)
+        raise
+
+    if compression != "none":
+        info.FileHash = f'sha256:{nixbase32_encode(out.sha256.digest())}'
+        info.FileSize = os.path.getsize(tmp_name)
+    os.replace(tmp_name, nar_path)
+
+    info.URL = info.URL + ext
+    info.Compression = compression
+
+    return info
+
+def _recompress_nar_file(store_dir: str, hash: str, info: NarInfo, compression: str) -> NarInfo:
+    '''Recompress the NAR file of a single narinfo. Returns the updated narinfo
+    '''
+
+    nar_path = os.path.join(store_dir, 'nar')
+
+    old_compression = info.Compression
+    # Target compression
+    if compression == None or compression == "none":
+        ext = ""
+        info.Compression = "none"
+    elif compression == "xz":
+        ext = ".xz"
+        info.Compression = "xz"
+    elif compression == "zstd":
+        ext = ".zstd"
+        info.Compression = "zstd"
+    else:
+        raise Exception(f'Unsupported compression type: {compression}')
+
+    tmp_name = os.path.join(nar_path, f'{hash}.tmp.{os.getpid()}')
+
+    # Compress file
+    print(f"re-compressing {hash}: {old_compression} -> {compression}")
+    try:
+        with open(os.path.join(store_dir, info.URL), 'rb') as nar, \
+             open(tmp_name, 'wb') as file:
+            # The NAR is read once from start to end, let the kernel read ahead
+            _fadvise(nar, "POSIX_FADV_SEQUENTIAL")
+
+            out = _HashWriter(file)
+            with _open_decompressor(nar, old_compression) as src, \
+                 _open_compressor(out, info.Compression) as dst:
+                while chunk := src.read(CHUNK_SIZE):
+                    dst.write(chunk)
+    except BaseException:
+        # Do not leave a partial NAR behind, e.g. if the input is corrupt
+        _remove_if_exists(tmp_name)
+        raise
+
+    # Get hash
+    if compression == None or compression == 'none':
+        info.FileHash = None
+        info.FileSize = None
+        file_hash = info.NarHash.split(':')[1]
+    else:
+        file_hash = nixbase32_encode(out.sha256.digest())
+        info.FileHash = f'sha256:{file_hash}'
+        info.FileSize = os.path.getsize(tmp_name)
+
+    new_url = os.path.join('nar', f'{file_hash}.nar{ext}')
+    os.replace(tmp_name, os.path.join(store_dir, new_url))
+
+    info.URL = new_url
+
+    return info
+
 class NarStore:
-    def __init__(self, store_dir: str):
+
+    def __init__(self, store_dir: str, read_workers: int = READ_WORKERS):
         self.store_dir = store_dir
+        self.read_workers = read_workers
         self.by_hash = None
         self.by_url = None
+        self.nar_files = {}
+        self._store_mtime = None
+        self._read_pool = None
+        self._session = None
+
+        # Narinfo files read by this process: {hash: (mtime_ns, size, NarInfo)}
+        self._narinfo_cache = {}
+
+        # Loaded on first use, see _get_index
+        self._index = None
+        self._index_dirty = False
+        atexit.register(self._save_index)
+
+    def _http_session(self) -> requests.Session:
+        '''HTTP session shared by all cache queries of this store
+        '''
+        if self._session == None:
+            self._session = http_session()
+
+        return self._session
+
+    def _index_path(self) -> str:
+        '''Path of the file holding the parsed narinfo files of previous runs.
+           It lives in the user's cache directory, not in the (often shared
+           and served) binary cache, with one file per store directory
+        '''
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        store_key = hashlib.sha256(os.path.realpath(self.store_dir).encode()).hexdigest()
+
+        return os.path.join(cache_home, "nartool", f"index-{store_key}.pkl")
+
+    def _get_index(self) -> dict:
+        '''Get the narinfo index, load it on first use
+        '''
+        if self._index == None:
+            self._index = self._load_index()
+
+        return self._index
+
+    def _load_index(self) -> dict:
+        '''Load the narinfo index: {hash: (mtime_ns, size, NarInfo)}
+        '''
+        try:
+            with open(self._index_path(), 'rb') as file:
+                index = pickle.load(file)
+        except Exception:
+            # A missing or broken index only means re-parsing the narinfo files
+            return {}
+
+        if type(index) != dict:
+            return {}
+
+        return index
+
+    def _save_index(self):
+        '''Write the narinfo index if it has changed
+        '''
+        if not self._index_dirty:
+            return
+
+        index_path = self._index_path()
+        tmp_path = f"{index_path}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(self._index, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, index_path)
+            self._index_dirty = False
+        except OSError as e:
+            print(f"Warning: could not write index {index_path}: {e}", file=sys.stderr)
 
     def get_narinfo_name(self, hash):
-        return os.path.join(self.store_dir, hash + ".narinfo")
+        return os.path.join(self.store_dir, f"{hash}.narinfo")
 
     def read_narinfo(self, hash: str) -> NarInfo:
-        '''Read a narinfo file
+        '''Read a narinfo file. Files, which did not change since
+           they were last read by this process, are not parsed again
         '''
         with open(self.get_narinfo_name(hash), 'r') as file:
-            lines = file.read()
+            st = os.fstat(file.fileno())
+            key = (st.st_mtime_ns, st.st_size)
 
-        return NarInfo(lines)
+            cached = self._narinfo_cache.get(hash)
+            if cached != None and cached[:2] == key:
+                info = cached[2]
+            else:
+                info = NarInfo(file)
+                self._narinfo_cache[hash] = key + (info,)
+
+        # Callers may modify the narinfo, never hand out the cached object
+        return info.copy()
+
+    def _read_many(self, hashes: typing.Iterable[str]) -> typing.Dict[str, NarInfo]:
+        '''Read narinfo files, in parallel if read_workers > 1. Missing files are skipped
+        '''
+        def read(hash):
+            try:
+                return self.read_narinfo(hash)
+            except FileNotFoundError:
+                return None
+
+        hashes = list(hashes)
+
+        # Not worth a round trip through the pool
+        if self.read_workers <= 1 or len(hashes) < 2:
+            infos = map(read, hashes)
+        else:
+            if self._read_pool == None:
+                self._read_pool = ThreadPoolExecutor(max_workers=self.read_workers)
+
+            infos = self._read_pool.map(read, hashes)
+
+        return {hash: info for hash, info in zip(hashes, infos) if info != None}
 
     def write_narinfo(self, hash: str, info: NarInfo):
         '''Write a .narinfo file
@@ -216,23 +658,47 @@ class NarStore:
         with open(self.get_narinfo_name(hash), 'w') as file:
             file.write(info.to_str())
 
-    def get_closure(self, hash: str, narinfo_dict: typing.Optional[Closure] = None) -> Closure:
-        '''Get a narinfo file and all dependcies
+        # Rewriting an existing file does not change the directory mtime,
+        # make get_store look at the files again
+        self._store_mtime = None
+
+    def get_closure(self, hashes: typing.Union[str, typing.Iterable[str]], narinfo_dict: typing.Optional[Closure] = None) -> Closure:
+        '''Get narinfo files and all dependcies for one or more root hashes
         '''
 
         if narinfo_dict == None:
-            narinfo_dict = Closure()
+            narinfo_dict = Closure.unchecked()
 
-        if hash not in narinfo_dict:
-            try:
-                narinfo_dict[hash] = self.read_narinfo(hash)
+        if isinstance(hashes, str):
+            hashes = [ hashes ]
 
-                for ref in narinfo_dict[hash].References:
-                   ref_hash = hash_from_name(ref)
-                   if ref_hash != hash:
-                        narinfo_dict = self.get_closure(ref_hash, narinfo_dict)
-            except:
-                None
+        # Read the closure level by level, each level in parallel
+        frontier = [Closure.key_is_valid(hash) for hash in dict.fromkeys(hashes) if hash not in narinfo_dict]
+        roots = set(frontier)
+        seen = set(narinfo_dict) | roots
+        closure = {}
+
+        while frontier:
+            infos = self._read_many(frontier)
+
+            next_frontier = []
+            for hash in frontier:
+                if hash not in infos:
+                    # Missing references are expected, see get_missing_refs
+                    if hash in roots:
+                        print(f"Warning: {hash} not found in nar store", file=sys.stderr)
+                    continue
+
+                closure[hash] = infos[hash]
+                for ref_hash in infos[hash].ref_hashes:
+                    if ref_hash not in seen:
+                        seen.add(ref_hash)
+                        next_frontier.append(ref_hash)
+
+            frontier = next_frontier
+
+        # References are read from the store and need no validation
+        dict.update(narinfo_dict, closure)
 
         return narinfo_dict
 
@@ -241,53 +707,107 @@ class NarStore:
         '''Get the hashes of all references not explicitly in the closure
         '''
 
-        missing = []
-        for _, narinfo in closure.items():
-            for ref in narinfo.References:
-                if ref not in closure:
-                    missing.append(hash_from_name(ref))
+        # Compare by hash, references are basenames but closure keys are hashes.
+        # dict keeps the order of first appearance
+        missing = {}
+        for narinfo in closure.values():
+            for ref_hash in narinfo.ref_hashes:
+                if ref_hash not in closure:
+                    missing[ref_hash] = None
 
-
-        return missing
+        return list(missing)
 
     def get_closure_from_hashes(self, hashes: List[str]) -> Closure:
         '''Read all narinfo for the given lis of hashes
         '''
 
-        closure = Closure()
+        infos = self._read_many(filter(nix_hash_is_valid, hashes))
 
+        closure = {}
         for hash in hashes:
-            try:
-                closure[hash] = self.read_narinfo(hash)
-            except:
-                print("Warning: " + hash + " not found in nar store", file=sys.stderr)
+            if hash in infos:
+                closure[hash] = infos[hash]
+            else:
+                print(f"Warning: {hash} not found in nar store", file=sys.stderr)
 
-        return closure
+        return Closure.unchecked(closure)
 
 
     def get_store(self):
-        '''Get all narinfo files in store
+        '''Get all narinfo files in store. The store is only read again
+           if files were added, removed or renamed since the last call
         '''
-        by_hash = Closure()
+        # Taken before the scan, changes during the scan trigger a new one
+        store_mtime = os.stat(self.store_dir).st_mtime_ns
+        if self.by_hash != None and self.by_url != None and store_mtime == self._store_mtime:
+            return self.by_hash, self.by_url
+
+        stats = {}
+        with os.scandir(self.store_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".narinfo") and entry.is_file():
+                    st = entry.stat()
+                    stats[entry.name[:32]] = (st.st_mtime_ns, st.st_size)
+
+        # Only parse files that changed since the index was written
+        old_index = self._get_index()
+        changed = {hash for hash, key in stats.items() if old_index.get(hash, ())[:2] != key}
+        if changed:
+            self._index_dirty = True
+        infos = self._read_many(changed)
+
+        by_hash = {}
         by_url = {}
-        for f in os.listdir(self.store_dir):
-            f = os.path.join(self.store_dir, f)
-            if os.path.isfile(f):
-                _, ext = os.path.splitext(f)
-                if ext == ".narinfo":
-                    hash = hash_from_name(f)
-                    ni = self.read_narinfo(hash)
-                    by_hash[hash] = ni
-
-                    if ni.URL in by_url:
-                        by_url[ni.URL].append(hash)
-                    else:
-                        by_url[ni.URL] = [ hash ]
+        index = {}
+        for hash, key in stats.items():
+            if hash in infos:
+                ni = infos[hash]
+            elif hash not in changed:
+                ni = old_index[hash][2]
+            else:
+                # Removed while reading the store
+                continue
+
+            index[hash] = key + (ni,)
+            by_hash[hash] = ni
 
+            if ni.URL in by_url:
+                by_url[ni.URL].append(hash)
+            else:
+                by_url[ni.URL] = [ hash ]
+
+        if len(index) != len(old_index):
+            self._index_dirty = True
+        self._index = index
+
+        by_hash = Closure.unchecked(by_hash)
         self.by_hash = by_hash
         self.by_url = by_url
+        self._store_mtime = store_mtime
         return by_hash, by_url
 
+    def scan_urls(self) -> typing.Set[str]:
+        '''Get the URLs of all narinfo files in store.
+           Lighter than get_store: files are only read up to their URL line.
+        '''
+        urls = set()
+        with os.scandir(self.store_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".narinfo") and entry.is_file():
+                    st = entry.stat()
+                    cached = self._get_index().get(entry.name[:32])
+                    if cached != None and cached[:2] == (st.st_mtime_ns, st.st_size):
+                        urls.add(cached[2].URL)
+                        continue
+
+                    with open(entry.path, 'r') as file:
+                        for line in file:
+                            if line.startswith("URL: "):
+                                urls.add(line[5:].strip())
+                                break
+
+        return urls
+
     def get_derivers(self, closure: Closure) -> List[str]:
         '''Get all derivers named by closure
         '''
@@ -335,10 +855,10 @@ class NarStore:
         files = []
         for hash, info in closure.items():
             if relative:
-                files.append(hash + ".narinfo")
+                files.append(f"{hash}.narinfo")
                 files.append(info.URL)
             else:
-                files.append(os.path.join(self.store_dir, hash + ".narinfo"))
+                files.append(os.path.join(self.store_dir, f"{hash}.narinfo"))
                 files.append(os.path.join(self.store_dir, info.URL))
 
         return files
@@ -346,11 +866,7 @@ class NarStore:
     def closure_to_json(self, closure: Closure) -> str:
         '''Convert closure data strucuture to JSON
         '''
-        cl = {}
-        for hash, narinfo in closure.items():
-            cl[hash] = asdict(narinfo)
-
-        return json.dumps(cl)
+        return json.dumps({hash: narinfo.to_dict() for hash, narinfo in closure.items()})
 
     # def get_removable_nar_files(self, file_hash: List[str]):
     #     '''Get a list of nar and narinfo files that can be removed.
@@ -358,42 +874,66 @@ class NarStore:
     #     '''
 
 
-    def find_orphaned_nar_files(self, nar_dir: str = "nar") -> List[str]:
-        '''Find nar files that are not referenced by any .narinfo
+    def get_nar_files(self, nar_dir: str = "nar") -> typing.Set[str]:
+        '''Get the URLs of all files in a NAR subdirectory. Each directory is only read once
         '''
 
-        if self.by_hash == None or self.by_url == None:
-            self.get_store()
+        if nar_dir not in self.nar_files:
+            urls = set()
+            nar_path = os.path.join(self.store_dir, nar_dir)
 
-        nar_path = os.path.join(self.store_dir, nar_dir)
+            try:
+                with os.scandir(nar_path) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            urls.add(os.path.join(nar_dir, entry.name))
+            except FileNotFoundError:
+                None
 
-        orphans = []
-        # Get all files in nar subdir and match against narinfos
-        for fname in os.listdir(nar_path):
-            fpath = os.path.join(nar_path, fname)
-            if os.path.isfile(fpath):
-                url = os.path.join(nar_dir, fname)
+            self.nar_files[nar_dir] = urls
 
-                if not url in self.by_url:
-                    orphans.append(fpath)
+        return self.nar_files[nar_dir]
 
-        return orphans
+    def _forget_nar_files(self, url: str):
+        '''Drop the cached listing of the directory a NAR was written to
+        '''
+        self.nar_files.pop(os.path.dirname(url), None)
+
+    def find_orphaned_nar_files(self, nar_dir: str = "nar") -> List[str]:
+        '''Find nar files that are not referenced by any .narinfo
+        '''
+
+        if self.by_url != None:
+            # Loaded already, get_store only re-reads if the store changed
+            urls = self.get_store()[1].keys()
+        else:
+            urls = self.scan_urls()
+
+        orphans = self.get_nar_files(nar_dir) - urls
+
+        return [os.path.join(self.store_dir, url) for url in sorted(orphans)]
 
 
     def find_orphaned_narinfo_files(self, closure: typing.Optional[Closure] = None) -> List[str]:
         '''Find narinfo files that point to non-existent NAR files
         '''
 
-        if closure == None:
+        # Listing the NAR directories only pays off when checking the whole store
+        whole_store = closure == None
+        if whole_store:
             closure, _ = self.get_store()
 
         missing_narinfo_path = []
 
         for hash, narinfo in closure.items():
-            narinfo.URL
-            nar_path = os.path.join(self.store_dir, narinfo.URL)
-            if not os.path.isfile(nar_path):
-                missing_narinfo_path.append(os.path.join(self.store_dir, hash + ".narinfo"))
+            nar_dir = os.path.dirname(narinfo.URL)
+            if whole_store or nar_dir in self.nar_files:
+                present = narinfo.URL in self.get_nar_files(nar_dir)
+            else:
+                present = os.path.isfile(os.path.join(self.store_dir, narinfo.URL))
+
+            if not present:
+                missing_narinfo_path.append(os.path.join(self.store_dir, f"{hash}.narinfo"))
 
         return missing_narinfo_path
 
@@ -402,199 +942,208 @@ class NarStore:
         '''Find all files, that are avaible in external caches
         '''
 
+        session = self._http_session()
+        cache_urls = available_caches(cache_urls, session)
+
         def check_caches(hash):
             for cache in cache_urls:
-                url = cache + "/" + hash + ".narinfo"
+                url = f"{cache}/{hash}.narinfo"
 
-                if url[0] == "/":
+                if url.startswith("/"):
                     if os.path.isfile(url):
                         return True
                 else:
                     try:
-                        res = requests.get(url, timeout=10)
+                        # Only the status code is of interest. Follow redirects,
+                        # caches may point to a CDN for the actual file
+                        res = session.head(url, timeout=10, allow_redirects=True)
                         if res.status_code == 200:
                             return True
-                    except:
-                        print("Warning download failed " + url, file=sys.stderr)
+                    except requests.RequestException:
+                        print(f"Warning download failed {url}", file=sys.stderr)
 
             return False
 
         if closure == None:
             closure, _ = self.get_store()
 
-        available = []
-        for hash, info in closure.items():
-
-            if not check_refs:
-                if check_caches(hash):
-                    available.append(hash)
+        if check_refs:
+            # Probe every missing reference once, no matter how often it is referenced
+            hashes = self.get_missing_refs(closure)
+        else:
+            hashes = list(closure)
 
-            if check_refs:
-                for ref in info.References:
-                    ref = hash_from_name(ref)
-                    if ref not in closure:
-                        if check_caches(ref):
-                            available.append(ref)
+        with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+            cached = pool.map(check_caches, hashes)
 
-        return available
+        return [hash for hash, available in zip(hashes, cached) if available]
 
     def fetch_from_cache(self, hashes: List[str], cache_urls: List[str] = ["https://cache.nixos.org"]):
         '''Fetch NAR + narinfo files from cache
         '''
 
-        for hash in hashes:
-            found = False
+        session = self._http_session()
+        cache_urls = available_caches(cache_urls, session)
+
+        def fetch(hash):
+            print(f"fetching {hash}")
             for cache in cache_urls:
-                url = cache + "/" + hash + ".narinfo"
-                print("fetching {}".format(hash))
-                if url[0] == "/":
+                url = f"{cache}/{hash}.narinfo"
+                if url.startswith("/"):
                     if os.path.isfile(url):
-                        with open(url, 'r') as file:
-                            info = NarInfo(file.read())
+                        try:
+                            with open(url, 'r') as file:
+                                info = NarInfo(file)
+
+                            nar_path = os.path.join(self.store_dir, info.URL)
+                            tmp_name = f"{nar_path}.{hash}.tmp"
+
+                            # copyfile uses sendfile on Linux, the data does not pass through Python.
+                            # Only add the narinfo once its NAR is complete
+                            try:
+                                shutil.copyfile(os.path.join(cache, info.URL), tmp_name)
+                                os.replace(tmp_name, nar_path)
+                                self._forget_nar_files(info.URL)
+                            except OSError:
+                                _remove_if_exists(tmp_name)
+                                raise
+
+                            shutil.copyfile(url, self.get_narinfo_name(hash))
+                            return True
 
-                        os.system("cp " + url + " " + self.get_narinfo_name(hash))
-                        os.system("cp " + os.path.join(cache, info.URL) + " " + os.path.join(self.store_dir, info.URL))
-                        found = True
+                        except (OSError, ValueError, AttributeError) as e:
+                            # Missing NAR, unwritable store or malformed narinfo
+                            print(f"Warning copy failed {url}: {e}", file=sys.stderr)
                 else:
                     try:
-                        res = requests.get(url, timeout=3)
+                        res = session.get(url, timeout=(3, 30))
                         if res.status_code == 200:
-                            found = True
                             info = NarInfo(res.text)
-                            with open(os.path.join(self.store_dir, hash + ".narinfo"), 'w') as file:
+                            nar_path = os.path.join(self.store_dir, info.URL)
+                            tmp_name = f"{nar_path}.{hash}.tmp"
+
+                            # Stream the NAR to disk, it may not fit into memory.
+                            # iter_content (unlike res.raw) undoes a Content-Encoding of the server
+                            sha256 = hashlib.sha256()
+                            try:
+                                with session.get(f"{cache}/{info.URL}", stream=True, timeout=(3, 60)) as nar:
+                                    nar.raise_for_status()
+                                    with open(tmp_name, 'wb') as file:
+                                        for chunk in nar.iter_content(CHUNK_SIZE):
+                                            sha256.update(chunk)
+                                            file.write(chunk)
+                            except BaseException:
+                                # Do not leave a partial download behind
+                                _remove_if_exists(tmp_name)
+                                raise
+
+                            file_hash = f"sha256:{nixbase32_encode(sha256.digest())}"
+                            if info.FileHash != None and info.FileHash.startswith("sha256:") and info.FileHash != file_hash:
+                                os.remove(tmp_name)
+                                print(f"Warning: hash mismatch for {cache}/{info.URL} ({file_hash} != {info.FileHash})", file=sys.stderr)
+                                continue
+
+                            # Only add the narinfo once its NAR is complete
+                            os.replace(tmp_name, nar_path)
+                            self._forget_nar_files(info.URL)
+                            with open(self.get_narinfo_name(hash), 'w') as file:
                                 file.write(res.text)
-                            res = requests.get(cache + "/" + info.URL, timeout=3)
-                            if res.status_code == 200:
-                                with open(os.path.join(self.store_dir, info.URL), 'wb') as file:
-                                    file.write(res.content)
+                            return True
+
+                    except requests.RequestException:
+                        print(f"Warning download failed {url}", file=sys.stderr)
+                    except (OSError, ValueError, AttributeError) as e:
+                        # Unwritable store or malformed narinfo, try the next cache
+                        print(f"Warning download failed {url}: {e}", file=sys.stderr)
+
+            return False
 
-                    except:
-                        print("Warning download failed " + url, file=sys.stderr)
+        pathlib.Path(os.path.join(self.store_dir, "nar")).mkdir(parents=True, exist_ok=True)
 
-            if not found:
-                print("Warning: file {} not found in any cache.".format(hash), file=sys.stderr)
+        with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+            for hash, found in zip(hashes, pool.map(fetch, hashes)):
+                if not found:
+                    print(f"Warning: file {hash} not found in any cache.", file=sys.stderr)
 
 
-    def recompress_nar(self, hashes, compression: str = "xz") -> tuple[int, int]:
-        '''Recompress given NAR file and update narinfo
+    def recompress_nar(self, hashes: List[str], compression: str = "xz") -> tuple[int, int]:
+        '''Recompress given NAR files and update narinfo
         '''
 
         size_old = 0
         size_new = 0
 
-        nar_path = os.path.join(self.store_dir, 'nar')
-
-        for hash in hashes:
-            info = self.read_narinfo(hash)
-
-            # Current compression
-            if info.Compression == 'none':
-                cmd = 'cat '
-            elif info.Compression == 'xz':
-                cmd = 'xz -dc '
-            elif info.Compression == 'zstd':
-                cmd = 'zstd -dc '
-            else:
-                raise Exception('Unsupported compression type: ' + info.Compression)
-
-            cmd = cmd + os.path.join(self.store_dir, info.URL) + ' | '
+        infos = [self.read_narinfo(hash) for hash in hashes]
 
-            if info.FileSize == None:
-                size_old = size_old + info.NarSize
-            else:
-                size_old = size_old + info.FileSize
-
-            old_compression = info.Compression
-            # Target compression
-            if compression == None or compression == "none":
-                cmd = cmd + 'cat > '
-                ext = ""
-                info.Compression = "none"
-            elif compression == "xz":
-                cmd = cmd + 'xz -z > '
-                ext = ".xz"
-                info.Compression = "xz"
-            elif compression == "zstd":
-                cmd = cmd + 'zstd > '
-                ext = ".zstd"
-                info.Compression = "zstd"
-            else:
-                raise Exception('Unsupported compression type: ' + compression)
-
-            tmp_name = os.path.join(nar_path, hash + '.tmp')
-            cmd = cmd + tmp_name
+        # Compression is CPU bound, process files in parallel
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            jobs = [ pool.submit(_recompress_nar_file, self.store_dir, hash, info, compression) for hash, info in zip(hashes, infos) ]
 
-            # Compress file
-            print("re-compressing {}: {} -> {}".format(hash, old_compression, compression))
-            os.system(cmd);
-
-            # Get hash
-            if compression == None or compression == 'none':
-                info.FileHash = None
-                info.FileSize = None
-                file_hash = info.NarHash.split(':')[1]
-            else:
-                type = 'sha256'
-                file_hash = subprocess.run(['nix', 'hash', 'file', '--base32', '--type', type, tmp_name], stdout=subprocess.PIPE).stdout.decode().strip()
-                info.FileHash = type + ':' + file_hash
-                info.FileSize = os.path.getsize(tmp_name)
+            # A failing file must not lose the narinfos of the others.
+            # Sizes only count files that were recompressed
+            for hash, old_info, job in zip(hashes, infos, jobs):
+                try:
+                    info = job.result()
+                except Exception as e:
+                    print(f"Warning: re-compressing {hash} failed: {e}", file=sys.stderr)
+                    continue
 
-            new_url = os.path.join('nar', file_hash + '.nar' + ext)
-            os.system('mv ' + tmp_name + ' ' + os.path.join(self.store_dir, new_url))
+                self._forget_nar_files(info.URL)
+                self.write_narinfo(hash, info)
 
-            info.URL = new_url
-            self.write_narinfo(hash, info)
+                if old_info.FileSize == None:
+                    size_old = size_old + old_info.NarSize
+                else:
+                    size_old = size_old + old_info.FileSize
 
-            if info.FileSize == None:
-                size_new = size_new + info.NarSize
-            else:
-                size_new = size_new + info.FileSize
+                if info.FileSize == None:
+                    size_new = size_new + info.NarSize
+                else:
+                    size_new = size_new + info.FileSize
 
         return size_old, size_new
 
     def nix_copy(self, closure: Closure, compression: str = "xz") -> int:
-        '''Copy a closure. If caches is given only paths not in cache will be copied
+        '''Copy a closure. If caches is given only paths not in cache will be copied.
+           Paths that fail to copy are removed from closure
         '''
         nix_store = NixStore()
         pathlib.Path(os.path.join(self.store_dir, "nar")).mkdir(parents=True, exist_ok=True)
 
-        copy_counter = 0
+        if compression == "none":
+            ext = ""
+        elif compression == "xz":
+            ext = ".xz"
+        elif compression == "zstd":
+            ext = ".zstd"
+        else:
+            raise(Exception("Invalid compression method"))
 
+        # Skip existing paths
+        to_copy = {}
         for hash, info in closure.items():
-            # Skip existing paths
             if not os.path.isfile(self.get_narinfo_name(hash)):
-                print("copy: {}".format(info.StorePath), file=sys.stderr)
-                info.URL = os.path.join("nar", info.NarHash[7:] + ".nar") #FIXME
-
-                nar_path = os.path.join(self.store_dir, info.URL)
-                with open(nar_path, 'wb') as nar:
-                    nar.write(nix_store.dump_nar(info))
-
-                if compression == "xz":
-                    os.system("xz " + nar_path)
-                    info.URL = info.URL + ".xz"
-                    info.Compression = "xz"
-                    nar_path = os.path.join(self.store_dir, info.URL)
-                elif compression == "zstd":
-                    os.system("zstd --rm " + nar_path + " " + "-o " + nar_path + ".zstd")
-                    info.URL = info.URL + ".zstd"
-                    info.Compression = "zstd"
-                    nar_path = os.path.join(self.store_dir, info.URL)
-                elif compression == "none":
-                    None
-                else:
-                    raise(Exception("Invalid compression method"))
-
-                if compression != "none":
-                    type = 'sha256'
-                    file_hash = subprocess.run(['nix', 'hash', 'file', '--base32', '--type', type, nar_path], stdout=subprocess.PIPE).stdout.decode().strip()
-                    info.FileHash = type + ':' + file_hash
-                    info.FileSize = os.path.getsize(nar_path)
-
+                to_copy[hash] = info
+            else:
+                print(f"skip: {info.StorePath} (already present)", file=sys.stderr)
+
+        # nix dumps and compresses outside of the GIL, copy paths in parallel
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            jobs = [ pool.submit(_copy_nar_file, nix_store, self.store_dir, info, compression, ext) for info in to_copy.values() ]
+
+            # A failing path must not lose the narinfos of the others
+            copy_counter = 0
+            for (hash, info), job in zip(to_copy.items(), jobs):
+                try:
+                    info = job.result()
+                except Exception as e:
+                    print(f"Warning: copying {info.StorePath} failed: {e}", file=sys.stderr)
+                    closure.pop(hash)
+                    continue
+
+                self._forget_nar_files(info.URL)
                 self.write_narinfo(hash, info)
                 copy_counter = copy_counter + 1
-            else:
-                print("skip: {} (already present)".format(info.StorePath), file=sys.stderr)
 
         return copy_counter
 